@@ -1,11 +1,16 @@
+import json
+import sys
 import iso8601
-from typing import Optional, Callable, Dict, Any, List
+from typing import Optional, Callable, Dict, Any, List, Tuple
 from inspect import signature
-from functools import wraps
-from datetime import timedelta
+from functools import lru_cache, wraps
+from itertools import islice
+from datetime import datetime, timedelta
+from weakref import WeakKeyDictionary
 
 from aw_core.models import Event
 from aw_datastore import Datastore
+from aw_datastore.datastore import Bucket
 
 from aw_transform import (
     filter_period_intersect,
@@ -13,11 +18,13 @@ from aw_transform import (
     filter_keyvals_regex,
     period_union,
     union_no_overlap,
+    union_many,
     categorize,
     tag,
     Rule,
     merge_events_by_keys,
     chunk_events_by_key,
+    chunk_events_by_key_iter,
     sort_by_timestamp,
     sort_by_duration,
     sum_durations,
@@ -31,9 +38,35 @@ from aw_transform import (
 from .exceptions import QueryFunctionException
 
 
-def _verify_bucket_exists(datastore, bucketname):
-    if bucketname in datastore.buckets():
-        return
+@lru_cache(maxsize=1024)
+def _parse_iso(timestamp: str) -> datetime:
+    # Every query_bucket call in a query parses the same STARTTIME/ENDTIME
+    return iso8601.parse_date(timestamp)
+
+
+# Bucket metadata by bucket id for each datastore, so a query calling query_bucket
+# many times doesn't list all buckets every time. query2.query() invalidates it before
+# running a query, and a lookup that misses refreshes it once before failing.
+_bucket_cache: "WeakKeyDictionary[Datastore, Dict[str, dict]]" = WeakKeyDictionary()
+
+
+def _get_buckets(datastore: Datastore, refresh: bool = False) -> Dict[str, dict]:
+    buckets = None if refresh else _bucket_cache.get(datastore)
+    if buckets is None:
+        buckets = _bucket_cache[datastore] = datastore.buckets()
+    return buckets
+
+
+def invalidate_bucket_cache(datastore: Datastore) -> None:
+    _bucket_cache.pop(datastore, None)
+
+
+def _verify_bucket_exists(datastore, bucketname) -> Bucket:
+    """Returns the bucket, raises a QueryFunctionException if it doesn't exist"""
+    if bucketname in _get_buckets(datastore):
+        return datastore[bucketname]
+    elif bucketname in _get_buckets(datastore, refresh=True):
+        return datastore[bucketname]
     else:
         raise QueryFunctionException(f"There's no bucket named '{bucketname}'")
 
@@ -70,26 +103,45 @@ def q2_function(transform_func=None):
 
     def h(f):
         sig = signature(f)
+        annotations = [param.annotation for param in sig.parameters.values()]
+        wants_namespace = TNamespace in annotations
+        wants_datastore = Datastore in annotations
         # If function lacks docstring, use docstring from underlying function in aw_transform
         if transform_func and transform_func.__doc__ and not f.__doc__:
             f.__doc__ = ".. note:: Documentation automatically copied from underlying function `aw_transform.{func_name}`\n\n{func_doc}".format(
                 func_name=transform_func.__name__, func_doc=transform_func.__doc__
             )
 
-        @wraps(f)
-        def g(datastore: Datastore, namespace: TNamespace, *args, **kwargs):
-            # Remove datastore and namespace argument for functions that don't need it
-            args = (datastore, namespace, *args)
-            if TNamespace not in (sig.parameters[p].annotation for p in sig.parameters):
-                args = (args[0], *args[2:])
-            if Datastore not in (sig.parameters[p].annotation for p in sig.parameters):
-                args = args[1:]
-            return f(*args, **kwargs)
+        # Remove datastore and namespace argument for functions that don't need it,
+        # picking the wrapper once here instead of slicing args on every call
+        if wants_datastore and wants_namespace:
+
+            @wraps(f)
+            def g(datastore: Datastore, namespace: TNamespace, *args, **kwargs):
+                return f(datastore, namespace, *args, **kwargs)
+
+        elif wants_datastore:
+
+            @wraps(f)
+            def g(datastore: Datastore, namespace: TNamespace, *args, **kwargs):
+                return f(datastore, *args, **kwargs)
+
+        elif wants_namespace:
+
+            @wraps(f)
+            def g(datastore: Datastore, namespace: TNamespace, *args, **kwargs):
+                return f(namespace, *args, **kwargs)
+
+        else:
+
+            @wraps(f)
+            def g(datastore: Datastore, namespace: TNamespace, *args, **kwargs):
+                return f(*args, **kwargs)
 
         fname = f.__name__
         if fname[:3] == "q2_":
             fname = fname[3:]
-        functions[fname] = g
+        functions[sys.intern(fname)] = g
         return g
 
     return h
@@ -98,20 +150,22 @@ def q2_function(transform_func=None):
 def q2_typecheck(f):
     """Decorator that typechecks using `_verify_variable_is_type`"""
     sig = signature(f)
+    # Positions and types of the arguments to check, worked out once from the signature
+    # FIXME: Won't check keyword arguments
+    checks = [
+        (i, param.annotation)
+        for i, param in enumerate(sig.parameters.values())
+        if param.annotation in [list, str, int, float] and param.default == param.empty
+    ]
 
     @wraps(f)
     def g(*args, **kwargs):
         # FIXME: If the first argument passed to a query2 function is a straight [] then the second argument disappears from the argument list for unknown reasons, which breaks things
-        for i, p in enumerate(sig.parameters):
-            param = sig.parameters[p]
-
-            # print(f"Checking that param ({param}) was {param.annotation}, value: {args[i]}")
-            # FIXME: Won't check keyword arguments
-            if (
-                param.annotation in [list, str, int, float]
-                and param.default == param.empty
-            ):
-                _verify_variable_is_type(args[i], param.annotation)
+        for i, t in checks:
+            # Exact type match is by far the common case, only fall back to the
+            # isinstance check (which also accepts subclasses) when it isn't
+            if type(args[i]) is not t:
+                _verify_variable_is_type(args[i], t)
 
         return f(*args, **kwargs)
 
@@ -129,14 +183,14 @@ def q2_find_bucket(
     datastore: Datastore, filter_str: str, hostname: Optional[str] = None
 ):
     """Find bucket by using a filter_str (to avoid hardcoding bucket names)"""
-    for bucket in datastore.buckets():
-        if filter_str in bucket:
-            bucket_metadata = datastore[bucket].metadata()
-            if hostname:
-                if bucket_metadata["hostname"] == hostname:
+    for refresh in (False, True):
+        for bucket, bucket_metadata in _get_buckets(datastore, refresh).items():
+            if filter_str in bucket:
+                if hostname:
+                    if bucket_metadata["hostname"] == hostname:
+                        return bucket
+                else:
                     return bucket
-            else:
-                return bucket
     raise QueryFunctionException(
         "Unable to find bucket matching '{}' (hostname filter set to '{}')".format(
             filter_str, hostname
@@ -154,15 +208,15 @@ def q2_find_bucket(
 def q2_query_bucket(
     datastore: Datastore, namespace: TNamespace, bucketname: str
 ) -> List[Event]:
-    _verify_bucket_exists(datastore, bucketname)
+    bucket = _verify_bucket_exists(datastore, bucketname)
     try:
-        starttime = iso8601.parse_date(namespace["STARTTIME"])
-        endtime = iso8601.parse_date(namespace["ENDTIME"])
+        starttime = _parse_iso(namespace["STARTTIME"])
+        endtime = _parse_iso(namespace["ENDTIME"])
     except iso8601.ParseError:
         raise QueryFunctionException(
             "Unable to parse starttime/endtime for query_bucket"
         )
-    return datastore[bucketname].get(starttime=starttime, endtime=endtime)
+    return bucket.get(starttime=starttime, endtime=endtime)
 
 
 @q2_function()
@@ -170,10 +224,15 @@ def q2_query_bucket(
 def q2_query_bucket_eventcount(
     datastore: Datastore, namespace: TNamespace, bucketname: str
 ) -> int:
-    _verify_bucket_exists(datastore, bucketname)
-    starttime = iso8601.parse_date(namespace["STARTTIME"])
-    endtime = iso8601.parse_date(namespace["ENDTIME"])
-    return datastore[bucketname].get_eventcount(starttime=starttime, endtime=endtime)
+    bucket = _verify_bucket_exists(datastore, bucketname)
+    try:
+        starttime = _parse_iso(namespace["STARTTIME"])
+        endtime = _parse_iso(namespace["ENDTIME"])
+    except iso8601.ParseError:
+        raise QueryFunctionException(
+            "Unable to parse starttime/endtime for query_bucket_eventcount"
+        )
+    return bucket.get_eventcount(starttime=starttime, endtime=endtime)
 
 
 """
@@ -234,6 +293,18 @@ def q2_chunk_events_by_key(events: list, key: str) -> List[Event]:
     return chunk_events_by_key(events, key)
 
 
+@q2_function(chunk_events_by_key)
+@q2_typecheck
+def q2_chunk_events_by_key_limited(events: list, key: str, count: int) -> List[Event]:
+    """Same as chunk_events_by_key, but stops after the first `count` chunks"""
+    # The typecheck only ensures an int, islice also rejects negative counts
+    if count < 0:
+        raise QueryFunctionException(
+            f"Count passed to chunk_events_by_key_limited must not be negative, was {count}"
+        )
+    return list(islice(chunk_events_by_key_iter(events, key), count))
+
+
 """
     Sort functions
 """
@@ -274,6 +345,12 @@ def q2_union_no_overlap(events1: list, events2: list) -> List[Event]:
     return union_no_overlap(events1, events2)
 
 
+@q2_function(union_many)
+@q2_typecheck
+def q2_union_many(events_lists: list) -> List[Event]:
+    return union_many(events_lists)
+
+
 """
     Flood functions
 """
@@ -319,15 +396,32 @@ def q2_nop():
 """
 
 
+@lru_cache(maxsize=64)
+def _build_rules(rule_dicts_json: str) -> List[Rule]:
+    return [Rule(rule_dict) for rule_dict in json.loads(rule_dicts_json)]
+
+
+def _build_classes(classes: list) -> List[Tuple[Any, Rule]]:
+    """
+    Pairs each class with its compiled Rule. Clients tend to send the same classes with
+    every query, so the Rules (and their compiled regexes) are cached by their JSON.
+    """
+    rule_dicts = [rule_dict for _, rule_dict in classes]
+    try:
+        rules = _build_rules(json.dumps(rule_dicts, sort_keys=True))
+    except TypeError:
+        # Not JSON serializable, build the rules without caching
+        rules = [Rule(rule_dict) for rule_dict in rule_dicts]
+    return [(_cls, rule) for (_cls, _), rule in zip(classes, rules)]
+
+
 @q2_function(categorize)
 @q2_typecheck
 def q2_categorize(events: list, classes: list):
-    classes = [(_cls, Rule(rule_dict)) for _cls, rule_dict in classes]
-    return categorize(events, classes)
+    return categorize(events, _build_classes(classes))
 
 
 @q2_function(tag)
 @q2_typecheck
 def q2_tag(events: list, classes: list):
-    classes = [(_cls, Rule(rule_dict)) for _cls, rule_dict in classes]
-    return tag(events, classes)
+    return tag(events, _build_classes(classes))
@@ -1,4 +1,5 @@
 import logging
+import sys
 from datetime import datetime
 from typing import (
     Any,
@@ -12,7 +13,7 @@ from typing import (
 from aw_datastore import Datastore
 
 from .exceptions import QueryInterpretException, QueryParseException
-from .functions import functions
+from .functions import functions, invalidate_bucket_cache
 
 logger = logging.getLogger(__name__)
 
@@ -128,7 +129,8 @@ class QFunction(QToken):
         self.args = args
 
     def interpret(self, datastore: Datastore, namespace: dict):
-        if self.name not in functions:
+        function = functions.get(self.name)
+        if function is None:
             raise QueryInterpretException(
                 f"Tried to call function '{self.name}' which doesn't exist"
             )
@@ -137,7 +139,7 @@ class QFunction(QToken):
             call_args.append(arg.interpret(datastore, namespace))
         # logger.debug("Arguments for functioncall to {} is {}".format(self.name, call_args))
         try:
-            result = functions[self.name](*call_args)  # type: ignore
+            result = function(*call_args)  # type: ignore
         except TypeError:
             raise QueryInterpretException(
                 "Tried to call function {} with invalid amount of arguments".format(
@@ -155,8 +157,8 @@ class QFunction(QToken):
             if char == "(":
                 break
             arg_start = arg_start + 1
-        # Parse name
-        name = string[:arg_start]
+        # Parse name, interned so it shares identity with the registered key
+        name = sys.intern(string[:arg_start])
         # Parse arguments
         args = []
         args_str = string[arg_start + 1 : arg_end]
@@ -408,6 +410,9 @@ def query(
     namespace["STARTTIME"] = starttime.isoformat()
     namespace["ENDTIME"] = endtime.isoformat()
 
+    # Buckets may have been created or removed since the last query
+    invalidate_bucket_cache(datastore)
+
     query_stmts = query.split(";")
     for statement in query_stmts:
         statement = statement.strip()
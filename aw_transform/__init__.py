@@ -1,8 +1,13 @@
 from .filter_keyvals import filter_keyvals, filter_keyvals_regex
-from .filter_period_intersect import filter_period_intersect, period_union, union
+from .filter_period_intersect import (
+    filter_period_intersect,
+    period_union,
+    union,
+    union_many,
+)
 from .heartbeats import heartbeat_merge, heartbeat_reduce
 from .merge_events_by_keys import merge_events_by_keys
-from .chunk_events_by_key import chunk_events_by_key
+from .chunk_events_by_key import chunk_events_by_key, chunk_events_by_key_iter
 from .sort_by import (
     sort_by_timestamp,
     sort_by_duration,
@@ -25,6 +30,7 @@ __all__ = [
     "period_union",
     "filter_period_intersect",
     "union",
+    "union_many",
     "union_no_overlap",
     "concat",
     "sum_durations",
@@ -34,6 +40,7 @@ __all__ = [
     "heartbeat_merge",
     "merge_events_by_keys",
     "chunk_events_by_key",
+    "chunk_events_by_key_iter",
     "limit_events",
     "filter_keyvals",
     "filter_keyvals_regex",
@@ -1,12 +1,46 @@
 import logging
-from datetime import timedelta
-from typing import List
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, List, Optional
 
 from aw_core.models import Event
 
 logger = logging.getLogger(__name__)
 
 
+def chunk_events_by_key_iter(
+    events: Iterable[Event], key: str, pulsetime: float = 5.0
+) -> Iterator[Event]:
+    """Lazy version of :func:`chunk_events_by_key`, yields each chunk once it is complete"""
+    pulse_td = timedelta(seconds=pulsetime)
+    last_chunk: Optional[Event] = None
+    prev_end: Optional[datetime] = None
+    for event in events:
+        event_data = event.data
+        if key not in event_data:
+            break
+        value = event_data[key]
+        timestamp = event.timestamp
+        duration = event.duration
+        if (
+            last_chunk is not None
+            and prev_end is not None
+            and last_chunk.data[key] == value
+            and timestamp - prev_end < pulse_td
+        ):
+            last_chunk.duration += duration
+            last_chunk.data["subevents"].append(event)
+        else:
+            if last_chunk is not None:
+                yield last_chunk
+            data = {key: value, "subevents": [event]}
+            last_chunk = Event(timestamp=timestamp, duration=duration, data=data)
+        # Gaps are measured from the end of the previous event
+        prev_end = timestamp + duration
+
+    if last_chunk is not None:
+        yield last_chunk
+
+
 def chunk_events_by_key(
     events: List[Event], key: str, pulsetime: float = 5.0
 ) -> List[Event]:
@@ -14,26 +48,4 @@ def chunk_events_by_key(
     "Chunks" adjacent events together which have the same value for a key, and stores the
     original events in the :code:`subevents` key of the new event.
     """
-    chunked_events: List[Event] = []
-    for event in events:
-        if key not in event.data:
-            break
-        timediff = timedelta(seconds=999999999)  # FIXME: ugly but works
-        if len(chunked_events) > 0:
-            timediff = event.timestamp - (events[-1].timestamp + events[-1].duration)
-        if (
-            len(chunked_events) > 0
-            and chunked_events[-1].data[key] == event.data[key]
-            and timediff < timedelta(seconds=pulsetime)
-        ):
-            chunked_event = chunked_events[-1]
-            chunked_event.duration += event.duration
-            chunked_event.data["subevents"].append(event)
-        else:
-            data = {key: event.data[key], "subevents": [event]}
-            chunked_event = Event(
-                timestamp=event.timestamp, duration=event.duration, data=data
-            )
-            chunked_events.append(chunked_event)
-
-    return chunked_events
+    return list(chunk_events_by_key_iter(events, key, pulsetime))
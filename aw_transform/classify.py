@@ -1,14 +1,29 @@
-from typing import Pattern, List, Iterable, Tuple, Dict, Optional, Any
-from functools import reduce
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+)
 import re
+from functools import lru_cache
 
 from aw_core import Event
 
-
 Tag = str
 Category = List[str]
 
 
+@lru_cache(maxsize=512)
+def _compile_cached(regex_str: str, ignore_case: bool) -> Pattern:
+    return re.compile(regex_str, (re.IGNORECASE if ignore_case else 0) | re.UNICODE)
+
+
 class Rule:
     regex: Optional[Pattern]
     select_keys: Optional[List[str]]
@@ -20,53 +35,70 @@ class Rule:
 
         # NOTE: Also checks that the regex isn't an empty string (which would erroneously match everything)
         regex_str = rules.get("regex", None)
-        self.regex = (
-            re.compile(
-                regex_str, (re.IGNORECASE if self.ignore_case else 0) | re.UNICODE
-            )
-            if regex_str
-            else None
-        )
+        self.regex = _compile_cached(regex_str, self.ignore_case) if regex_str else None
 
     def match(self, e: Event) -> bool:
-        if self.select_keys:
-            values = [e.data.get(key, None) for key in self.select_keys]
-        else:
-            values = list(e.data.values())
-        if self.regex:
-            for val in values:
-                if isinstance(val, str) and self.regex.search(val):
-                    return True
-        return False
+        if not self.regex:
+            return False
+        return _matches_any(self.regex.search, _str_values(e, self.select_keys))
 
 
 def categorize(
     events: List[Event], classes: List[Tuple[Category, Rule]]
 ) -> List[Event]:
-    return [_categorize_one(e, classes) for e in events]
-
-
-def _categorize_one(e: Event, classes: List[Tuple[Category, Rule]]) -> Event:
-    e.data["$category"] = _pick_category(
-        [_cls for _cls, rule in classes if rule.match(e)]
-    )
-    return e
+    for e, matched in zip(events, _match_classes(events, classes)):
+        e.data["$category"] = _pick_category(matched)
+    return events
 
 
 def tag(events: List[Event], classes: List[Tuple[Tag, Rule]]) -> List[Event]:
-    return [_tag_one(e, classes) for e in events]
-
-
-def _tag_one(e: Event, classes: List[Tuple[Tag, Rule]]) -> Event:
-    e.data["$tags"] = [_cls for _cls, rule in classes if rule.match(e)]
-    return e
-
-
-def _pick_category(tags: Iterable[Category]) -> Category:
-    return reduce(_pick_deepest_cat, tags, ["Uncategorized"])
-
-
-def _pick_deepest_cat(t1: Category, t2: Category) -> Category:
-    # t1 will be the accumulator when used in reduce
-    # Always bias against t1, since it could be "Uncategorized"
-    return t2 if len(t2) >= len(t1) else t1
+    for e, matched in zip(events, _match_classes(events, classes)):
+        e.data["$tags"] = matched
+    return events
+
+
+def _match_classes(events: List[Event], classes: List[Tuple[Any, Rule]]) -> List[list]:
+    """
+    Returns, for each event, the classes whose rule matches it (in the order of ``classes``).
+
+    Equivalent to checking ``rule.match(e)`` for every pair, but loops over the rules
+    on the outside so each event's string values are only extracted once per distinct
+    ``select_keys`` instead of once per rule.
+    """
+    matched: List[list] = [[] for _ in events]
+    values_by_keys: Dict[Optional[Tuple[str, ...]], List[List[str]]] = {}
+    for _cls, rule in classes:
+        if type(rule).match is not Rule.match:
+            # Subclasses with their own matching logic are asked directly
+            for event_matched, e in zip(matched, events):
+                if rule.match(e):
+                    event_matched.append(_cls)
+            continue
+        if not rule.regex:
+            continue
+        keys = tuple(rule.select_keys) if rule.select_keys else None
+        values = values_by_keys.get(keys)
+        if values is None:
+            values = values_by_keys[keys] = [list(_str_values(e, keys)) for e in events]
+        search = rule.regex.search
+        for event_matched, event_values in zip(matched, values):
+            if _matches_any(search, event_values):
+                event_matched.append(_cls)
+    return matched
+
+
+def _str_values(e: Event, keys: Optional[Sequence[str]]) -> Iterator[str]:
+    """Yields the string values of the event's data, only those under ``keys`` if given"""
+    values = map(e.data.get, keys) if keys else e.data.values()
+    return (val for val in values if type(val) is str)
+
+
+def _matches_any(search: Callable[[str], Any], values: Iterable[str]) -> bool:
+    # Stops at the first matching value
+    return any(search(val) for val in values)
+
+
+def _pick_category(tags: List[Category]) -> Category:
+    # Picks the deepest category, the last one wins on ties (max keeps the first maximum
+    # it sees, hence reversed). Empty categories never win over "Uncategorized".
+    return max(reversed(tags), key=len, default=None) or ["Uncategorized"]
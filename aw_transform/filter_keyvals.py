@@ -1,5 +1,6 @@
 import logging
-from typing import List
+from functools import lru_cache
+from typing import Collection, List, Pattern
 import re
 
 from aw_core.models import Event
@@ -7,11 +8,29 @@ from aw_core.models import Event
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=128)
+def _compile(regex: str) -> Pattern:
+    return re.compile(regex)
+
+
 def filter_keyvals(
     events: List[Event], key: str, vals: List[str], exclude=False
 ) -> List[Event]:
+    try:
+        vals_set: Collection = frozenset(vals)
+    except TypeError:
+        # Some values aren't hashable (such as lists), fall back to the list
+        vals_set = vals
+
     def predicate(event):
-        return key in event.data and event.data[key] in vals
+        data = event.data
+        if key not in data:
+            return False
+        try:
+            return data[key] in vals_set
+        except TypeError:
+            # The event value isn't hashable, so can't be looked up in a set
+            return data[key] in vals
 
     if exclude:
         return [e for e in events if not predicate(e)]
@@ -20,9 +39,9 @@ def filter_keyvals(
 
 
 def filter_keyvals_regex(events: List[Event], key: str, regex: str) -> List[Event]:
-    r = re.compile(regex)
+    r = _compile(regex)
 
     def predicate(event):
-        return key in event.data and bool(r.findall(event.data[key]))
+        return key in event.data and r.search(event.data[key]) is not None
 
     return [e for e in events if predicate(e)]
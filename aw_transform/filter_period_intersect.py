@@ -1,6 +1,10 @@
+import heapq
+from bisect import bisect_left
 import logging
-from typing import List, Iterable, Tuple
-from copy import deepcopy
+from datetime import datetime, timedelta
+from itertools import accumulate, groupby
+from operator import attrgetter, le
+from typing import List, Iterable, Optional, Tuple
 
 from aw_core import Event
 from timeslot import Timeslot
@@ -8,17 +12,13 @@ from timeslot import Timeslot
 logger = logging.getLogger(__name__)
 
 
-def _get_event_period(event: Event) -> Timeslot:
-    start = event.timestamp
-    end = start + event.duration
-    return Timeslot(start, end)
-
-
 def _replace_event_period(event: Event, period: Timeslot) -> Event:
-    e = deepcopy(event)
-    e.timestamp = period.start
-    e.duration = period.duration
-    return e
+    return Event(
+        id=event.id,
+        timestamp=period.start,
+        duration=period.duration,
+        data=dict(event.data),
+    )
 
 
 def _intersecting_eventpairs(
@@ -27,30 +27,62 @@ def _intersecting_eventpairs(
     """A generator that yields each overlapping pair of events from two eventlists along with a Timeslot of the intersection"""
     events1.sort(key=lambda e: e.timestamp)
     events2.sort(key=lambda e: e.timestamp)
+    # Periods are worked out once up front and compared directly, which gives the
+    # same result as Timeslot.intersection (without building Timeslots for every step)
+    # as long as no event has a negative duration
+    starts1 = [e.timestamp for e in events1]
+    ends1 = [start + e.duration for start, e in zip(starts1, events1)]
+    starts2 = [e.timestamp for e in events2]
+    ends2 = [start + e.duration for start, e in zip(starts2, events2)]
+    n1 = len(events1)
+    n2 = len(events2)
+    # Running maximum of the end times. Since it never decreases it can be bisected to
+    # skip past a whole run of events that end before the other event starts, which
+    # is common when one list is sparse (such as short non-AFK periods).
+    maxends1 = list(accumulate(ends1, max))
+    maxends2 = list(accumulate(ends2, max))
+    # Negative durations do occur in practice. Timeslot.intersection then follows
+    # different rules, so use it directly and don't skip (skipped events could intersect).
+    no_negative = all(map(le, starts1, ends1)) and all(map(le, starts2, ends2))
     e1_i = 0
     e2_i = 0
-    while e1_i < len(events1) and e2_i < len(events2):
-        e1 = events1[e1_i]
-        e2 = events2[e2_i]
-        e1_p = _get_event_period(e1)
-        e2_p = _get_event_period(e2)
+    while e1_i < n1 and e2_i < n2:
+        e1_start = starts1[e1_i]
+        e1_end = ends1[e1_i]
+        e2_start = starts2[e2_i]
+        e2_end = ends2[e2_i]
+
+        ip: Optional[Timeslot] = None
+        if no_negative:
+            ip_start = e1_start if e1_start > e2_start else e2_start
+            ip_end = e1_end if e1_end < e2_end else e2_end
+            # Periods merely touching don't intersect, unless one of them has zero duration
+            if ip_start < ip_end or (
+                ip_start == ip_end and (e1_start == e1_end or e2_start == e2_end)
+            ):
+                ip = Timeslot(ip_start, ip_end)
+        else:
+            ip = Timeslot(e1_start, e1_end).intersection(Timeslot(e2_start, e2_end))
 
-        ip = e1_p.intersection(e2_p)
         if ip:
             # If events intersected, yield events
-            yield (e1, e2, ip)
-            if e1_p.end <= e2_p.end:
+            yield (events1[e1_i], events2[e2_i], ip)
+            if e1_end <= e2_end:
                 e1_i += 1
             else:
                 e2_i += 1
         else:
             # No intersection, check if event is before/after filterevent
-            if e1_p.end <= e2_p.start:
+            if e1_end <= e2_start:
                 # Event ended before filter event started
                 e1_i += 1
-            elif e2_p.end <= e1_p.start:
+                if no_negative and e1_i < n1 and maxends1[e1_i] < e2_start:
+                    e1_i = bisect_left(maxends1, e2_start, e1_i + 1)
+            elif e2_end <= e1_start:
                 # Event started after filter event ended
                 e2_i += 1
+                if no_negative and e2_i < n2 and maxends2[e2_i] < e1_start:
+                    e2_i = bisect_left(maxends2, e1_start, e2_i + 1)
             else:
                 logger.error("Should be unreachable, skipping period")
                 e1_i += 1
@@ -104,23 +136,38 @@ def period_union(events1: List[Event], events2: List[Event]) -> List[Event]:
         result    | -----------  -- --------- |
     """
     events = sorted(events1 + events2)
-    merged_events = []
-    if events:
-        merged_events.append(events.pop(0))
-    for e in events:
-        last_event = merged_events[-1]
-
-        e_p = _get_event_period(e)
-        le_p = _get_event_period(last_event)
-
-        if not e_p.gap(le_p):
-            new_period = e_p.union(le_p)
-            merged_events[-1] = _replace_event_period(last_event, new_period)
+    merged_events: List[Event] = []
+    it = iter(events)
+    first = next(it, None)
+    if first is None:
+        return merged_events
+    # The merged period is tracked as plain datetimes and an Event (without data)
+    # is only created once it can't be extended any further
+    last_id = first.id
+    last_start = first.timestamp
+    last_end = last_start + first.duration
+    for e in it:
+        start = e.timestamp
+        end = start + e.duration
+        if end < last_start or last_end < start:
+            # There's a gap, so the last period is done
+            merged_events.append(
+                Event(
+                    id=last_id,
+                    timestamp=last_start,
+                    duration=last_end - last_start,
+                    data={},
+                )
+            )
+            last_id = e.id
+            last_start = start
+            last_end = end
         else:
-            merged_events.append(e)
-    for event in merged_events:
-        # Clear data
-        event.data = {}
+            last_start = min(start, last_start)
+            last_end = max(end, last_end)
+    merged_events.append(
+        Event(id=last_id, timestamp=last_start, duration=last_end - last_start, data={})
+    )
     return merged_events
 
 
@@ -135,39 +182,42 @@ def union(events1: List[Event], events2: List[Event]) -> List[Event]:
 
         events = union(events_backup, events_living)
     """
+    return union_many([events1, events2])
 
-    events1 = sorted(events1, key=lambda e: (e.timestamp, e.duration))
-    events2 = sorted(events2, key=lambda e: (e.timestamp, e.duration))
-    events_union = []
 
-    e1_i = 0
-    e2_i = 0
-    while e1_i < len(events1) and e2_i < len(events2):
-        e1 = events1[e1_i]
-        e2 = events2[e2_i]
-
-        if e1 == e2:
-            events_union.append(e1)
-            e1_i += 1
-            e2_i += 1
-        else:
-            if e1.timestamp < e2.timestamp:
-                events_union.append(e1)
-                e1_i += 1
-            elif e1.timestamp > e2.timestamp:
-                events_union.append(e2)
-                e2_i += 1
-            elif e1.duration < e2.duration:
-                events_union.append(e1)
-                e1_i += 1
-            else:
-                events_union.append(e2)
-                e2_i += 1
+def union_many(events_lists: List[List[Event]]) -> List[Event]:
+    """
+    Concatenates and sorts union of any number of event lists and removes duplicates.
 
-    if e1_i < len(events1):
-        events_union.extend(events1[e1_i:])
+    Same as :func:`union`, but merges all the lists in a single pass instead of
+    one pair at a time. An event that occurs in several lists is kept as many
+    times as it occurs in the list where it is most frequent.
+    """
+
+    def _key(item: Tuple[int, Event]) -> Tuple[datetime, timedelta]:
+        return item[1].timestamp, item[1].duration
 
-    if e2_i < len(events2):
-        events_union.extend(events2[e2_i:])
+    sorted_lists = [
+        [(i, e) for e in sorted(events, key=attrgetter("timestamp", "duration"))]
+        for i, events in enumerate(events_lists)
+    ]
+    events_union: List[Event] = []
+    # Duplicates have the same timestamp and duration, so they end up next to each other
+    for _, group in groupby(heapq.merge(*sorted_lists, key=_key), key=_key):
+        kept: List[Event] = []
+        unmatched: List[Event] = []
+        list_i = -1
+        for i, e in group:
+            if i != list_i:
+                # Events of the next list may be duplicates of any event kept so far
+                list_i = i
+                unmatched = kept.copy()
+            for j, e_kept in enumerate(unmatched):
+                if e == e_kept:
+                    del unmatched[j]
+                    break
+            else:
+                kept.append(e)
+        events_union.extend(kept)
 
     return events_union
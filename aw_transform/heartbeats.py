@@ -9,10 +9,13 @@ logger = logging.getLogger(__name__)
 
 def heartbeat_reduce(events: List[Event], pulsetime: float) -> List[Event]:
     """Merges consecutive events together according to the rules of `heartbeat_merge`."""
-    reduced = []
-    if events:
-        reduced.append(events.pop(0))
-    for heartbeat in events:
+    reduced: List[Event] = []
+    # Iterate instead of pop(0), which is O(n) and modifies the caller's list
+    it = iter(events)
+    first = next(it, None)
+    if first is not None:
+        reduced.append(first)
+    for heartbeat in it:
         merged = heartbeat_merge(reduced[-1], heartbeat, pulsetime)
         if merged is not None:
             # Heartbeat was merged
@@ -30,7 +33,10 @@ def heartbeat_merge(
     Merges two events if they have identical data
     and the heartbeat timestamp is within the pulsetime window.
     """
-    if last_event.data == heartbeat.data:
+    last_data = last_event.data
+    heartbeat_data = heartbeat.data
+    # Heartbeats often share the same data dict, in which case comparing contents is unnecessary
+    if last_data is heartbeat_data or last_data == heartbeat_data:
         # Seconds between end of last_event and start of heartbeat
         pulseperiod_end = (
             last_event.timestamp + last_event.duration + timedelta(seconds=pulsetime)
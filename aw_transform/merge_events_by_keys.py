@@ -1,10 +1,13 @@
 import logging
+from datetime import timedelta
 from typing import List, Dict, Tuple
 
 from aw_core.models import Event
 
 logger = logging.getLogger(__name__)
 
+_MICROSECOND = timedelta(microseconds=1)
+
 
 def merge_events_by_keys(events, keys) -> List[Event]:
     """
@@ -16,25 +19,26 @@ def merge_events_by_keys(events, keys) -> List[Event]:
     if len(keys) < 1:
         return events
     merged_events: Dict[Tuple, Event] = {}
+    # Durations are summed as integer microseconds (exact, same as timedelta), which
+    # avoids creating a new timedelta for every merged event
+    durations: Dict[Tuple, int] = {}
     for event in events:
-        composite_key: Tuple = ()
-        for key in keys:
-            if key in event.data:
-                val = event["data"][key]
-                # Needed for when the value is a list, such as for categories
-                if isinstance(val, list):
-                    val = tuple(val)
-                composite_key = composite_key + (val,)
-        if composite_key not in merged_events:
+        data = event.data
+        # Lists (such as categories) are turned into tuples so that they can be hashed
+        composite_key: Tuple = tuple(
+            tuple(val) if isinstance(val, list) else val
+            for val in [data[key] for key in keys if key in data]
+        )
+        total = durations.get(composite_key)
+        if total is None:
             merged_events[composite_key] = Event(
-                timestamp=event.timestamp, duration=event.duration, data={}
+                timestamp=event.timestamp,
+                duration=event.duration,
+                data={key: data[key] for key in keys if key in data},
             )
-            for key in keys:
-                if key in event.data:
-                    merged_events[composite_key].data[key] = event.data[key]
+            durations[composite_key] = event.duration // _MICROSECOND
         else:
-            merged_events[composite_key].duration += event.duration
-    result = []
-    for key in merged_events:
-        result.append(Event(**merged_events[key]))
-    return result
+            durations[composite_key] = total + event.duration // _MICROSECOND
+    for composite_key, merged_event in merged_events.items():
+        merged_event.duration = timedelta(microseconds=durations[composite_key])
+    return list(merged_events.values())
@@ -1,30 +1,41 @@
 import re
-from copy import deepcopy
 from typing import List
 
 from aw_core import Event
 
+_RE_LEADINGDOT = re.compile(r"^(●|\*)\s*")
+_RE_PARENSPREFIX = re.compile(r"^\([0-9]+\)\s*")
+_RE_FPS = re.compile(r"FPS:\s+[0-9\.]+")
 
-def simplify_string(events: List[Event], key: str = "title") -> List[Event]:
-    events = deepcopy(events)
 
-    re_leadingdot = re.compile(r"^(●|\*)\s*")
-    re_parensprefix = re.compile(r"^\([0-9]+\)\s*")
-    re_fps = re.compile(r"FPS:\s+[0-9\.]+")
+def simplify_string(events: List[Event], key: str = "title") -> List[Event]:
+    # Only data is modified, so copying it is enough to leave the input events untouched
+    events = [
+        Event(id=e.id, timestamp=e.timestamp, duration=e.duration, data=dict(e.data))
+        for e in events
+    ]
 
     for e in events:
+        data = e.data
+        value = data[key]
+        # The regexes are only run when a cheap substring check says they could match
+
         # Remove prefixes that are numbers within parenthesis
         # Example: "(2) Facebook" -> "Facebook"
         # Example: "(1) YouTube" -> "YouTube"
-        e.data[key] = re_parensprefix.sub("", e.data[key])
+        if value[:1] == "(":
+            value = _RE_PARENSPREFIX.sub("", value)
 
         # Things generally specific to window events with the "app" key
-        if key == "title" and "app" in e["data"]:
+        if key == "title" and "app" in data:
             # Remove FPS display in window title
             # Example: "Cemu - FPS: 59.2 - ..." -> "Cemu - FPS: ... - ..."
-            e.data[key] = re_fps.sub("FPS: ...", e.data[key])
+            if "FPS:" in value:
+                value = _RE_FPS.sub("FPS: ...", value)
 
             # For VSCode (uses ●), gedit (uses *), et al
             # See: https://github.com/ActivityWatch/aw-watcher-window/issues/32
-            e.data[key] = re_leadingdot.sub("", e.data[key])
+            if value[:1] in ("●", "*"):
+                value = _RE_LEADINGDOT.sub("", value)
+        data[key] = value
     return events
@@ -1,5 +1,6 @@
 import logging
 from datetime import timedelta
+from operator import attrgetter, itemgetter
 from typing import List
 from aw_core.models import Event
 
@@ -8,12 +9,13 @@ logger = logging.getLogger(__name__)
 
 def sort_by_timestamp(events) -> List[Event]:
     """Sorts a list of events by timestamp"""
-    return sorted(events, key=lambda e: e.timestamp)
+    # Event.timestamp just returns the "timestamp" item, read it directly from C
+    return sorted(events, key=itemgetter("timestamp"))
 
 
 def sort_by_duration(events) -> List[Event]:
     """Sorts a list of events by duration"""
-    return sorted(events, key=lambda e: e.duration, reverse=True)
+    return sorted(events, key=attrgetter("duration"), reverse=True)
 
 
 def limit_events(events, count) -> List[Event]:
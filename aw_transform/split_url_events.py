@@ -1,5 +1,7 @@
 import logging
-from typing import List
+import re
+from functools import lru_cache
+from typing import List, Tuple
 
 from urllib.parse import urlparse
 
@@ -8,20 +10,45 @@ from aw_core.models import Event
 logger = logging.getLogger(__name__)
 
 
+# Matches the common case of a plain http(s) URL in a single scan. Anything else
+# (other schemes, params, whitespace, IPv6 hosts, non-ASCII) is left to urlparse.
+_URL_RE = re.compile(
+    r"(https?)://(?:www\.)?([^/?#\[\]\s]*)(?=[/?#]|\Z)([^?#;\s]*)(?:\?([^#\s]*))?(?:#(\S*))?\Z"
+)
+
+
+@lru_cache(maxsize=8192)
+def _parse_url(url: str) -> Tuple[str, str, str, str, str, str]:
+    # Cached since a user's browsing history tends to revisit the same few URLs a lot
+    m = _URL_RE.match(url) if url.isascii() else None
+    if m:
+        scheme, domain, path, query, fragment = m.groups()
+        return (scheme, domain, path, "", query or "", fragment or "")
+    parsed_url = urlparse(url)
+    domain = (
+        parsed_url.netloc[4:] if parsed_url.netloc[:4] == "www." else parsed_url.netloc
+    )
+    return (
+        parsed_url.scheme,
+        domain,
+        parsed_url.path,
+        parsed_url.params,
+        parsed_url.query,
+        parsed_url.fragment,
+    )
+
+
 def split_url_events(events: List[Event]) -> List[Event]:
     for event in events:
         if "url" in event.data:
             url = event.data["url"]
-            parsed_url = urlparse(url)
-            event.data["$protocol"] = parsed_url.scheme
-            event.data["$domain"] = (
-                parsed_url.netloc[4:]
-                if parsed_url.netloc[:4] == "www."
-                else parsed_url.netloc
-            )
-            event.data["$path"] = parsed_url.path
-            event.data["$params"] = parsed_url.params
-            event.data["$options"] = parsed_url.query
-            event.data["$identifier"] = parsed_url.fragment
+            (
+                event.data["$protocol"],
+                event.data["$domain"],
+                event.data["$path"],
+                event.data["$params"],
+                event.data["$options"],
+                event.data["$identifier"],
+            ) = _parse_url(url)
             # TODO: Parse user, port etc aswell
     return events
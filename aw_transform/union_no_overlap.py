@@ -2,22 +2,23 @@
 Originally from aw-research
 """
 
-from copy import deepcopy
 from typing import List, Tuple, Optional
 from datetime import datetime, timedelta, timezone
 
-from timeslot import Timeslot
-
 from aw_core import Event
 
 
 def _split_event(e: Event, dt: datetime) -> Tuple[Event, Optional[Event]]:
     if e.timestamp < dt < e.timestamp + e.duration:
-        e1 = deepcopy(e)
-        e2 = deepcopy(e)
-        e1.duration = dt - e.timestamp
-        e2.timestamp = dt
-        e2.duration = (e.timestamp + e.duration) - dt
+        e1 = Event(
+            id=e.id, timestamp=e.timestamp, duration=dt - e.timestamp, data=dict(e.data)
+        )
+        e2 = Event(
+            id=e.id,
+            timestamp=dt,
+            duration=(e.timestamp + e.duration) - dt,
+            data=dict(e.data),
+        )
         return (e1, e2)
     else:
         return (e, None)
@@ -43,8 +44,8 @@ def union_no_overlap(events1: List[Event], events2: List[Event]) -> List[Event]:
       events1  |  ----     ------   -- |
       result   | xxx--  xx ----xxx  -- |
     """
-    events1 = deepcopy(events1)
-    events2 = deepcopy(events2)
+    # Split remainders are written back into events2, so don't modify the caller's list
+    events2 = list(events2)
 
     # I looked a lot at aw_transform.union when I wrote this
     events_union = []
@@ -53,28 +54,38 @@ def union_no_overlap(events1: List[Event], events2: List[Event]) -> List[Event]:
     while e1_i < len(events1) and e2_i < len(events2):
         e1 = events1[e1_i]
         e2 = events2[e2_i]
-        e1_p = Timeslot(e1.timestamp, e1.timestamp + e1.duration)
-        e2_p = Timeslot(e2.timestamp, e2.timestamp + e2.duration)
+        e1_start = e1.timestamp
+        e1_end = e1_start + e1.duration
+        e2_start = e2.timestamp
+        e2_end = e2_start + e2.duration
 
-        if e1_p.intersects(e2_p):
-            if e1.timestamp <= e2.timestamp:
+        # Same check as Timeslot.intersects, without building Timeslots for every step
+        if (
+            e1_start <= e2_start < e1_end
+            or e1_start < e2_end <= e1_end
+            or (e2_start <= e1_start and e1_end <= e2_end)
+        ):
+            if e1_start <= e2_start:
                 events_union.append(e1)
                 e1_i += 1
 
                 # If e2 continues after e1, we need to split up the event so we only get the part that comes after
-                _, e2_next = _split_event(e2, e1.timestamp + e1.duration)
+                _, e2_next = _split_event(e2, e1_end)
                 if e2_next:
                     events2[e2_i] = e2_next
                 else:
                     e2_i += 1
             else:
-                e2_next, e2_next2 = _split_event(e2, e1.timestamp)
+                e2_next, e2_next2 = _split_event(e2, e1_start)
                 events_union.append(e2_next)
-                e2_i += 1
+                # Continue with the remainder of e2 in its place, rather than inserting
+                # it into the list (which shifts every following event)
                 if e2_next2:
-                    events2.insert(e2_i, e2_next2)
+                    events2[e2_i] = e2_next2
+                else:
+                    e2_i += 1
         else:
-            if e1.timestamp <= e2.timestamp:
+            if e1_start <= e2_start:
                 events_union.append(e1)
                 e1_i += 1
             else:
@@ -8,7 +8,7 @@ from aw_core.models import Event
 from aw_datastore import get_storage_methods
 
 from . import context  # noqa: F401
-from .utils import param_datastore_objects, param_testing_buckets_cm
+from .utils import TempTestBucket, param_datastore_objects, param_testing_buckets_cm
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -164,6 +164,28 @@ def test_insert_many_upsert(bucket_cm):
             assert e.data["key"] == "new val"
 
 
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_insert_many_into_two_buckets(datastore):
+    """
+    Tests that inserting the same id-less events into two buckets
+    doesn't assign them ids that turn the second insert into an upsert
+    """
+    num_events = 3
+    events = [
+        Event(timestamp=now + i * td1s, duration=td1s, data={"key": "val"})
+        for i in range(num_events)
+    ]
+    bucket1_cm = TempTestBucket(datastore)
+    bucket2_cm = TempTestBucket(datastore)
+    bucket2_cm.bucket_id = bucket1_cm.bucket_id + "-2"
+    with bucket1_cm as bucket1, bucket2_cm as bucket2:
+        bucket1.insert(events)
+        bucket2.insert(events)
+        assert all(e.id is None for e in events)
+        assert num_events == len(bucket1.get(limit=-1))
+        assert num_events == len(bucket2.get(limit=-1))
+
+
 @pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
 def test_delete(bucket_cm):
     """
@@ -358,6 +380,28 @@ def test_get_event_trimming(bucket_cm):
         assert td1d == timedelta(seconds=round(total_duration.total_seconds()))
 
 
+@pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
+def test_get_event_longer_than_a_day(bucket_cm):
+    """Test that events starting more than 24h before the query range are still returned"""
+    from aw_datastore.storages import PeeweeStorage
+
+    with bucket_cm as bucket:
+        if not isinstance(bucket.ds.storage_strategy, PeeweeStorage):
+            pytest.skip("Trimming not supported for datastore")
+
+        event = Event(timestamp=now, duration=3 * td1d)
+        bucket.insert(event)
+
+        starttime = event.timestamp + 2 * td1d
+        fetched_events = bucket.get(-1, starttime=starttime, endtime=starttime + td1s)
+        assert 1 == len(fetched_events)
+        assert starttime == fetched_events[0].timestamp
+        assert td1s == timedelta(
+            seconds=round(fetched_events[0].duration.total_seconds())
+        )
+        assert 1 == bucket.get_eventcount(starttime=starttime)
+
+
 @pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
 def test_get_datefilter_start(bucket_cm):
     """
@@ -459,6 +503,35 @@ def test_replace(bucket_cm):
         assert bucket.get(-1)[2]["data"]["label"] == "test1-replaced"
 
 
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_replace_missing(datastore):
+    """
+    Tests that replacing an event that doesn't exist in the bucket raises
+    """
+    from aw_datastore.storages import PeeweeStorage
+    from aw_datastore.storages.peewee import EventModel
+
+    if not isinstance(datastore.storage_strategy, PeeweeStorage):
+        pytest.skip("Replacing missing events doesn't raise for datastore")
+
+    bucket1_cm = TempTestBucket(datastore)
+    bucket2_cm = TempTestBucket(datastore)
+    bucket2_cm.bucket_id = bucket1_cm.bucket_id + "-2"
+    with bucket1_cm as bucket1, bucket2_cm as bucket2:
+        e1 = bucket1.insert(Event(data={"label": "test1"}, timestamp=now))
+        assert e1 is not None and e1.id is not None
+
+        # Nonexistent id
+        with pytest.raises(EventModel.DoesNotExist):
+            bucket1.replace(e1.id + 1000, Event(data={"label": "new"}, timestamp=now))
+
+        # Id of an event in another bucket
+        with pytest.raises(EventModel.DoesNotExist):
+            bucket2.replace(e1.id, Event(data={"label": "new"}, timestamp=now))
+        assert bucket1.get(-1)[0].data["label"] == "test1"
+        assert 0 == len(bucket2.get(-1))
+
+
 @pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
 def test_replace_last(bucket_cm):
     """
@@ -564,6 +637,26 @@ def test_get_metadata(bucket_cm):
         bucket.metadata()
 
 
+def test_get_metadata_after_update_by_other_storage():
+    """
+    Tests that a bucket updated through one PeeweeStorage isn't served stale
+    from another, since they share the same database connection
+    """
+    from aw_datastore.storages import PeeweeStorage
+
+    storage1 = PeeweeStorage(testing=True)
+    storage2 = PeeweeStorage(testing=True)
+    bid = f"test-metadata-{random.randint(0, 10 ** 4)}"
+    storage1.create_bucket(bid, "testtype", "testclient", "old", now.isoformat())
+    try:
+        storage2.update_bucket_keys()
+        assert storage2.get_metadata(bid)["hostname"] == "old"
+        storage1.update_bucket(bid, hostname="new")
+        assert storage2.get_metadata(bid)["hostname"] == "new"
+    finally:
+        storage1.delete_bucket(bid)
+
+
 @pytest.mark.parametrize("bucket_cm", param_testing_buckets_cm())
 def test_get_eventcount(bucket_cm):
     """
@@ -584,3 +677,64 @@ def test_get_eventcount(bucket_cm):
         )
         assert bucket.get_eventcount(endtime=now + timedelta(seconds=1)) == 5
         assert bucket.get_eventcount(starttime=now + timedelta(seconds=1)) == 1
+
+
+def test_peewee_auto_migrate_timestamp_end(tmp_path):
+    """
+    Tests that auto_migrate adds the timestamp_end column to an existing database
+    and fills it in, also for rows written later without it (by older versions),
+    formatted the same way as when written by the storage itself
+    """
+    import sqlite3
+
+    from aw_datastore.storages.peewee import _event_to_fields, auto_migrate
+
+    path = str(tmp_path / "peewee-sqlite.v2.db")
+    conn = sqlite3.connect(path)
+    # Schema as created by versions without the timestamp_end column
+    conn.execute(
+        "CREATE TABLE bucketmodel (key INTEGER PRIMARY KEY, id VARCHAR(255) UNIQUE, "
+        "created DATETIME, name VARCHAR(255), type VARCHAR(255), "
+        "client VARCHAR(255), hostname VARCHAR(255))"
+    )
+    conn.execute(
+        "CREATE TABLE eventmodel (id INTEGER PRIMARY KEY, bucket_id INTEGER, "
+        "timestamp DATETIME, duration DECIMAL(10, 5), datastr VARCHAR(255))"
+    )
+    conn.execute(
+        "INSERT INTO eventmodel (bucket_id, timestamp, duration, datastr) "
+        "VALUES (1, '2020-01-01 00:00:00+00:00', 10, '{}')"
+    )
+    conn.commit()
+
+    auto_migrate(path)
+    # A row written afterwards by a version that doesn't know about the column,
+    # ending at a sub-second boundary
+    conn.execute(
+        "INSERT INTO eventmodel (bucket_id, timestamp, duration, datastr) "
+        "VALUES (1, '2020-01-01 01:00:00.250000+00:00', 1.25, '{}')"
+    )
+    # The same event, written with timestamp_end by the current version
+    fields = _event_to_fields(
+        Event(timestamp="2020-01-01T01:00:00.250+00:00", duration=1.25)
+    )
+    conn.execute(
+        "INSERT INTO eventmodel (bucket_id, timestamp, duration, datastr, timestamp_end) "
+        "VALUES (1, ?, ?, ?, ?)",
+        (
+            fields["timestamp"],
+            fields["duration"],
+            fields["datastr"],
+            fields["timestamp_end"],
+        ),
+    )
+    conn.commit()
+    auto_migrate(path)
+
+    rows = conn.execute("SELECT timestamp_end FROM eventmodel ORDER BY id").fetchall()
+    conn.close()
+    assert rows == [
+        ("2020-01-01 00:00:10+00:00",),
+        ("2020-01-01 01:00:01.500000+00:00",),
+        ("2020-01-01 01:00:01.500000+00:00",),
+    ]
@@ -266,6 +266,13 @@ def test_query2_function_invalid_types():
     with pytest.raises(QueryFunctionException):
         query(qname, example_query, starttime, endtime, ds)
 
+    # negative count (the parser has no negative literals, so the call is built directly)
+    qfunc = QFunction(
+        "chunk_events_by_key_limited", [QList([]), QString("label"), QInteger(-1)]
+    )
+    with pytest.raises(QueryFunctionException):
+        qfunc.interpret(ds, {})
+
     # FIXME: For unknown reasons, query2 drops the second argument
     #        when the first argument is a bare []
     """
@@ -335,6 +342,7 @@ def test_query2_query_functions(datastore):
     events = limit_events(events, 1);
     events = merge_events_by_keys(events, ["label"]);
     events = chunk_events_by_key(events, "label");
+    events = chunk_events_by_key_limited(events, "label", 1);
     events = split_url_events(events);
     events = sort_by_timestamp(events);
     events = sort_by_duration(events);
@@ -15,6 +15,7 @@ from aw_transform import (
     split_url_events,
     simplify_string,
     union,
+    union_many,
     union_no_overlap,
     categorize,
     tag,
@@ -307,6 +308,21 @@ def test_chunk_events_by_key():
     assert result[1].data["subevents"][0] == e3
 
 
+def test_chunk_events_by_key_pulsetime():
+    now = datetime.now(timezone.utc)
+    td1s = timedelta(seconds=1)
+    data = {"label": "a"}
+    e1 = Event(data=data, timestamp=now, duration=td1s)
+    e2 = Event(data=data, timestamp=now + 2 * td1s, duration=td1s)
+    # More than pulsetime after the end of e2, should start a new chunk
+    e3 = Event(data=data, timestamp=now + 10 * td1s, duration=td1s)
+    result = chunk_events_by_key([e1, e2, e3], "label", pulsetime=5)
+    assert len(result) == 2
+    assert result[0].data["subevents"] == [e1, e2]
+    assert result[0].duration == 2 * td1s
+    assert result[1].data["subevents"] == [e3]
+
+
 def test_url_parse_event():
     now = datetime.now(timezone.utc)
     e = Event(
@@ -384,6 +400,28 @@ def test_union():
     assert events_union == [e1, e2, e3, e4]
 
 
+def test_rule_match():
+    now = datetime.now(timezone.utc)
+    e = Event(timestamp=now, data={"app": "Firefox", "title": "GitHub", "count": 3})
+
+    assert Rule({"regex": "GitHub"}).match(e)
+    assert not Rule({"regex": "github"}).match(e)
+    assert Rule({"regex": "github", "ignore_case": True}).match(e)
+    assert not Rule({"regex": "GitHub", "select_keys": ["app"]}).match(e)
+    assert Rule({"regex": "Fire", "select_keys": ["app", "missing"]}).match(e)
+    # Non-string values are never matched, an empty regex never matches anything
+    assert not Rule({"regex": "3"}).match(e)
+    assert not Rule({"regex": ""}).match(e)
+
+    # categorize/tag go through the overridden match of Rule subclasses
+    class AppRule(Rule):
+        def match(self, e: Event) -> bool:
+            return e.data.get("app") == "Firefox"
+
+    events = tag([e], [("Browser", AppRule({}))])
+    assert events[0].data["$tags"] == ["Browser"]
+
+
 def test_categorize():
     now = datetime.now(timezone.utc)
 
@@ -423,6 +461,21 @@ def test_tags():
     assert len(events[1].data["$tags"]) == 0
 
 
+def test_union_many():
+    now = datetime.now(timezone.utc)
+    td1s = timedelta(seconds=1)
+
+    e1 = Event(timestamp=now, duration=td1s, data={"a": 1})
+    e2 = Event(timestamp=now, duration=td1s, data={"a": 2})
+    e3 = Event(timestamp=now + td1s, duration=td1s)
+    e4 = Event(timestamp=now + 2 * td1s, duration=td1s)
+
+    assert union_many([]) == []
+    assert union_many([[e4, e1], [e3, e1], [e2, e1, e4]]) == [e1, e2, e3, e4]
+    # Duplicates within a single list are kept
+    assert union_many([[e1, e1], [e1]]) == [e1, e1]
+
+
 def test_union_no_overlap():
     from pprint import pprint
 